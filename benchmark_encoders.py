@@ -0,0 +1,106 @@
+import argparse
+import os
+import tempfile
+import time
+import cv2
+import logging
+import pandas as pd
+
+import utils
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger("Benchmark Encoders")
+
+
+def parse_config(config_str):
+    """
+    Parse an encoder config string into EncoderSettings.
+    Example input: "ffmpeg:crf=28,preset=veryfast,gop=30"
+    """
+    backend, _, options = config_str.partition(":")
+    kwargs = {"backend": backend}
+    for item in filter(None, options.split(",")):
+        key, value = item.split("=")
+        kwargs[key.replace("-", "_")] = int(value) if value.isdigit() else value
+    try:
+        return utils.EncoderSettings(**kwargs)
+    except TypeError as e:
+        raise argparse.ArgumentTypeError(f"Invalid encoder config <{config_str}>: {e}")
+
+
+def read_frames(file, resolution, max_frames):
+    """Decode and resize the source once, so that only encoding is timed."""
+    cap = cv2.VideoCapture(file)
+    if not cap.isOpened():
+        raise ValueError(f"Cannot open video file: {file}")
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    frames = []
+    while len(frames) < max_frames:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        frames.append(cv2.resize(frame, resolution) if resolution else frame)
+    cap.release()
+    return frames, fps
+
+
+def decode_fps(file):
+    """Replay the file the same way the viewer does (sequential cap.read) and return frames per second."""
+    cap = cv2.VideoCapture(file)
+    frame_count = 0
+    start = time.perf_counter()
+    while True:
+        ret, _ = cap.read()
+        if not ret:
+            break
+        frame_count += 1
+    elapsed = time.perf_counter() - start
+    cap.release()
+    return frame_count / elapsed if elapsed > 0 else float("nan")
+
+
+def main(args):
+    frames, fps = read_frames(args.video, args.resolution, args.max_frames)
+    if not frames:
+        raise ValueError(f"No frames could be decoded from {args.video}")
+    height, width = frames[0].shape[:2]
+    logger.info(f"Benchmarking {len(frames)} frames at {width}x{height}, {fps:.2f} fps")
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for i, settings in enumerate(args.configs):
+            output_file = os.path.join(tmp_dir, f"bench_{i}.mp4")
+            start = time.perf_counter()
+            out = utils.make_encoder(output_file, fps, (width, height), settings)
+            for frame in frames:
+                out.write(frame)
+            out.release()
+            encode_time = time.perf_counter() - start
+
+            results.append({
+                "config": args.config_strings[i],
+                "encode_time_s": round(encode_time, 3),
+                "encode_fps": round(len(frames) / encode_time, 1),
+                "file_size_kb": round(os.path.getsize(output_file) / 1024, 1),
+                "decode_fps": round(decode_fps(output_file), 1),
+            })
+
+    df = pd.DataFrame(results)
+    print(df.to_string(index=False))
+    if args.output_csv:
+        df.to_csv(args.output_csv, index=False)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare encoder backends on encode time, file size and viewer decode fps.")
+    parser.add_argument("--video", type=str, required=True, help="Source video to encode.")
+    parser.add_argument("--resolution", type=lambda s: utils.parse_resolutions(s)[0], default=None, help="Resize to WIDTHxHEIGHT before encoding, e.g. 640x480.")
+    parser.add_argument("--max-frames", type=int, default=300, help="Maximum number of frames to encode.")
+    parser.add_argument("--configs", type=str, nargs="+", default=["opencv", "ffmpeg:crf=23,preset=veryfast", "ffmpeg:crf=28,preset=medium,gop=30"],
+                        help="Encoder configs as backend[:key=value,...], keys are EncoderSettings fields.")
+    parser.add_argument("--output-csv", type=str, default=None, help="Optionally save the results table to this csv.")
+
+    args = parser.parse_args()
+    args.config_strings = args.configs
+    args.configs = [parse_config(c) for c in args.configs]
+    main(args)
@@ -1,9 +1,21 @@
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 import cv2
+import fnmatch
+import json
+import numpy as np
 import os
 from pathlib import Path
 
-def crop_video(input_path, output_path, crop_top, crop_bottom, crop_left, crop_right):
+import utils
+
+def crop_video(input_path, output_path, crop_top, crop_bottom, crop_left, crop_right, encoder_settings=None, profiler=None):
+    profiler = profiler or utils.StageProfiler(enabled=False)
+    with profiler.span(input_path, "cropped"):
+        _crop_video(input_path, output_path, crop_top, crop_bottom, crop_left, crop_right, encoder_settings, profiler.stage)
+
+
+def _crop_video(input_path, output_path, crop_top, crop_bottom, crop_left, crop_right, encoder_settings, stage):
     cap = cv2.VideoCapture(str(input_path))
     if not cap.isOpened():
         print(f"Failed to open {input_path}")
@@ -21,22 +33,115 @@ def crop_video(input_path, output_path, crop_top, crop_bottom, crop_left, crop_r
         cap.release()
         return
 
-    fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-    out = cv2.VideoWriter(str(output_path), fourcc, fps, (new_width, new_height))
+    with stage("open", frames=0):
+        out = utils.make_encoder(str(output_path), fps, (new_width, new_height), encoder_settings)
 
     frame_count = 0
     while True:
-        ret, frame = cap.read()
+        with stage("decode") as record:
+            ret, frame = cap.read()
+            if not ret:
+                record.frames = 0
         if not ret:
             break
-        cropped_frame = frame[crop_top:height - crop_bottom, crop_left:width - crop_right, :]
-        out.write(cropped_frame)
+        with stage("crop"):
+            # slicing alone is a view, the copy into contiguous memory is the real cost of this stage
+            cropped_frame = np.ascontiguousarray(frame[crop_top:height - crop_bottom, crop_left:width - crop_right, :])
+        with stage("write"):
+            out.write(cropped_frame)
         frame_count += 1
 
     cap.release()
-    out.release()
+    with stage("finalize", frames=0):
+        out.release()
     print(f"Processed {frame_count} frames from {input_path.name} -> {output_path.name}")
 
+def sample_frames(input_path, num_frames=8):
+    """Seek to evenly spaced positions and return the sampled frames as a (K, H, W) grayscale stack."""
+    cap = cv2.VideoCapture(str(input_path))
+    frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    frames = []
+    for position in np.linspace(0, max(frame_count - 1, 0), num_frames).round().astype(int):
+        cap.set(cv2.CAP_PROP_POS_FRAMES, int(position))
+        ret, frame = cap.read()
+        if ret:
+            frames.append(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY))
+    cap.release()
+    return np.stack(frames) if frames else None
+
+
+def _main_run(active, weights):
+    """Start and end (exclusive) of the contiguous run of active indices carrying the most weight."""
+    edges = np.diff(np.concatenate(([0], active.astype(np.int8), [0])))
+    starts, ends = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+    if not starts.size:
+        return None
+    cumulative = np.concatenate(([0], np.cumsum(weights)))
+    best = int(np.argmax(cumulative[ends] - cumulative[starts]))
+    return int(starts[best]), int(ends[best])
+
+
+def detect_crop(frames, motion_threshold=8, min_fraction=0.05):
+    """
+    Find the ultrasound fan in a (K, H, W) sample. Overlay bands (patient banner, scanner text, scale
+    bars) are identical in every sampled frame while the fan changes, so pixels whose range over the
+    sample exceeds `motion_threshold` are treated as live image. The fan is the heaviest contiguous band
+    of rows, then of columns within it, where at least `min_fraction` of the pixels are live; small
+    moving overlays such as a clock fall outside that band. Returns (top, bottom, left, right) margins,
+    rounded so the cropped size is even, or None if nothing moves.
+    """
+    height, width = frames.shape[1:]
+    live = (frames.max(axis=0).astype(np.int16) - frames.min(axis=0)) > motion_threshold
+
+    row_fraction = live.mean(axis=1)
+    rows = _main_run(row_fraction >= min_fraction, row_fraction)
+    if rows is None:
+        return None
+    top, bottom = rows
+    col_fraction = live[top:bottom].mean(axis=0)
+    cols = _main_run(col_fraction >= min_fraction, col_fraction)
+    if cols is None:
+        return None
+    left, right = cols
+
+    # even dimensions keep yuv420p encoders happy
+    bottom -= (bottom - top) % 2
+    right -= (right - left) % 2
+    return top, height - bottom, left, width - right
+
+
+def _source_key(file_path):
+    stat = file_path.stat()
+    return {"size": stat.st_size, "mtime": stat.st_mtime}
+
+
+def load_crop_cache(cache_path):
+    if cache_path.exists():
+        with open(cache_path) as f:
+            return json.load(f)
+    return {}
+
+
+def process_file(file_path, output_path, manual_crop, auto_crop, cached, encoder_settings, num_samples, profile=False):
+    """
+    Worker: detect (or reuse) the crop for one source and write the cropped video.
+    Returns the detected crop, if any, and the worker's StageProfiler.
+    """
+    profiler = utils.StageProfiler(enabled=profile)
+    detected = None
+    if auto_crop:
+        if cached and cached["source"] == _source_key(file_path):
+            detected = tuple(cached["crop"])
+        else:
+            with profiler.span(file_path, "detect"), profiler.stage("detect", frames=num_samples):
+                frames = sample_frames(file_path, num_samples)
+                detected = detect_crop(frames) if frames is not None else None
+            if detected is None:
+                print(f"No moving image region found in {file_path.name}, falling back to the manual crop")
+    crop_video(file_path, output_path, *(detected or manual_crop), encoder_settings, profiler)
+    return detected, profiler
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Crop videos in a directory and save them to another directory.")
     parser.add_argument("--src_dir", type=str, required=True, help="Source directory containing original videos.")
@@ -45,6 +150,12 @@ if __name__ == "__main__":
     parser.add_argument("--crop_bottom", type=int, default=0, help="Height to crop from the bottom of the video.")
     parser.add_argument("--crop_left", type=int, default=0, help="Width to crop from the left of the video.")
     parser.add_argument("--crop_right", type=int, default=0, help="Width to crop from the right of the video.")
+    parser.add_argument("--auto_crop", action="store_true", help="Detect the crop per video from sampled frames instead of using the fixed margins (used as fallback).")
+    parser.add_argument("--auto_crop_samples", type=int, default=8, help="Number of frames sampled per video for crop detection.")
+    parser.add_argument("--name_pattern", type=str, default="Sag-D-", help="Only process files whose name (without extension) matches this glob, e.g. '*' for all.")
+    parser.add_argument("--workers", type=int, default=None, help="Number of videos processed in parallel.")
+    utils.add_encoder_arguments(parser)
+    utils.add_profiling_arguments(parser)
 
     args = parser.parse_args()
 
@@ -54,15 +165,49 @@ if __name__ == "__main__":
     crop_bottom = args.crop_bottom
     crop_left = args.crop_left
     crop_right = args.crop_right
+    encoder_settings = utils.encoder_settings_from_args(args)
 
     video_exts = {".mp4", ".MP4", ".avi", ".AVI"}
+    manual_crop = (crop_top, crop_bottom, crop_left, crop_right)
+
+    # detected crops are cached per source, keyed by relative path and invalidated when the source changes
+    cache_path = dst_dir / "crop_cache.json"
+    crop_cache = load_crop_cache(cache_path)
 
+    jobs = []
     for file_path in src_dir.rglob("*"):
         if file_path.suffix in video_exts:
             relative_path = file_path.relative_to(src_dir)
-            if file_path.stem == "Sag-D-":
+            if fnmatch.fnmatch(file_path.stem, args.name_pattern):
                 output_name = file_path.stem + "_cropped" + file_path.suffix
                 output_path = dst_dir / relative_path.parent / output_name
 
                 output_path.parent.mkdir(parents=True, exist_ok=True)
-                crop_video(file_path, output_path, crop_top, crop_bottom, crop_left, crop_right)
+                jobs.append((file_path, relative_path, output_path))
+
+    profiler = utils.StageProfiler(enabled=args.profile or bool(args.profile_json))
+    # cProfile only sees the parent process, the stage profiler collects the workers' timings
+    with utils.maybe_cprofile(args.cprofile), ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = {
+            str(relative_path): (file_path, executor.submit(
+                process_file, file_path, output_path, manual_crop, args.auto_crop,
+                crop_cache.get(str(relative_path)), encoder_settings, args.auto_crop_samples, profiler.enabled,
+            ))
+            for file_path, relative_path, output_path in jobs
+        }
+        for key, (file_path, future) in futures.items():
+            crop, worker_profiler = future.result()
+            profiler.merge(worker_profiler)
+            if crop is not None:
+                print(f"{key}: crop top={crop[0]} bottom={crop[1]} left={crop[2]} right={crop[3]}")
+                crop_cache[key] = {"source": _source_key(file_path), "crop": list(crop)}
+
+    if args.auto_crop:
+        dst_dir.mkdir(parents=True, exist_ok=True)
+        with open(cache_path, "w") as f:
+            json.dump(crop_cache, f, indent=1)
+
+    if profiler.enabled:
+        print(profiler.summary())
+        if args.profile_json:
+            profiler.save(args.profile_json)
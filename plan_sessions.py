@@ -0,0 +1,59 @@
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+import json
+import logging
+import os
+
+import utils
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger("Plan Sessions")
+
+
+def build_catalog(video_dir=None, archive_path=None):
+    """
+    One pass over the prepared videos: path, resolution and label of every rung. Archive clips are
+    listed by member name, so the plans work wherever the archive is opened from.
+    """
+    if archive_path:
+        archive = utils.StudyArchive(archive_path)
+        catalog = [
+            {"path": member, "resolution": (clip["width"], clip["height"]), "label": clip["label"]}
+            for member, clip in archive.clips.items()
+        ]
+        archive.close()
+        return catalog
+
+    def probe(path):
+        cap, info = utils.probe_video(path)
+        cap.release()
+        if not info["opened"] or info["width"] <= 0 or info["height"] <= 0:
+            raise utils.CorruptFileException(f"Corrupt file detected: {path}, run validate_data.py for details")
+        return {"path": path, "resolution": (info["width"], info["height"]), "label": os.path.basename(os.path.dirname(path))}
+
+    with ThreadPoolExecutor() as executor:
+        return list(executor.map(probe, utils.find_rungs(video_dir)))
+
+
+def main(args):
+    catalog = build_catalog(args.video_dir, args.archive)
+    plan = utils.compile_session_plans(catalog, args.readers, args.seed, args.lookahead)
+    plan["created"] = datetime.datetime.now().isoformat(timespec="seconds")
+    plan["source"] = args.archive or args.video_dir
+    with open(args.output, "w") as f:
+        json.dump(plan, f, indent=1)
+    logger.info(f"Plans for {args.readers} readers over {len(catalog)} videos saved at {args.output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compile seeded, counterbalanced session plans for several readers.")
+    parser.add_argument("--video_dir", type=str, default="ultrasounds", help="Directory in which ultrasound videos are located.")
+    parser.add_argument("--archive", type=str, default=None, help="Plan over a packed study archive instead of --video_dir.")
+    parser.add_argument("--readers", type=int, required=True, help="Number of readers to plan sessions for.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for flips and ordering; the same seed and data give the same plans.")
+    parser.add_argument("--lookahead", type=int, default=2, help="Number of upcoming clips the viewer pre-opens.")
+    parser.add_argument("--output", type=str, default="session_plans.json", help="Where to save the compiled plans.")
+
+    args = parser.parse_args()
+    main(args)
@@ -2,6 +2,7 @@ import argparse
 import os
 import cv2
 import logging
+import pandas as pd
 import re
 
 import utils
@@ -21,6 +22,8 @@ def get_resolution(file_path):
 
 
 def main(args):
+    encoder_settings = utils.encoder_settings_from_args(args)
+    profiler = utils.StageProfiler(enabled=args.profile or bool(args.profile_json))
     for dir in args.data_directories:
         original_files = []
         for file in os.listdir(dir):
@@ -33,20 +36,74 @@ def main(args):
         for _file in original_files:
             for sf in args.scale_factors:
                 x_res, y_res = get_resolution(os.path.join(dir, _file))
-                new_x_res = int(x_res*sf)
-                new_y_res = int(y_res*sf)
+                new_x_res, new_y_res = utils.even_resolution(x_res*sf, y_res*sf)
                 file_without_extension = _file.rsplit('.', 1)[0]
                 formatted_filename = f"{file_without_extension}_{new_x_res}x{new_y_res}.mp4"
                 requested_files.append((formatted_filename, _file, (new_x_res, new_y_res)))
                 
         files_to_make = [(cf, of, r) for cf, of, r in requested_files if cf not in os.listdir(dir)]
+        metrics_rows = []
+        poster_samplers = {}
         for _, original_file, target_res in files_to_make:
-            utils.make_resolution_copy(os.path.join(dir, original_file), target_res)
+            quality_metrics = utils.QualityMetrics(args.metrics_every, args.metrics_batch_size, args.metrics_mode) if args.quality_metrics else None
+            posters = utils.PosterSampler(args.poster_thumbnails, args.thumbnail_width) if args.posters else None
+            summary = utils.make_resolution_copy(os.path.join(dir, original_file), target_res, encoder_settings, quality_metrics, posters, profiler)
+            if summary:
+                metrics_rows.append(summary)
+            if posters:
+                file_base, file_ext = os.path.splitext(original_file)
+                poster_samplers[f"{file_base}_{target_res[0]}x{target_res[1]}{file_ext}"] = posters
+
+        if metrics_rows:
+            save_metrics_summary(dir, metrics_rows)
+        if args.posters:
+            update_poster_cache(dir, poster_samplers, args)
+
+    if args.pack_archive:
+        utils.write_archive(args.pack_archive, args.data_directories)
+
+    if profiler.enabled:
+        print(profiler.summary())
+        if args.profile_json:
+            profiler.save(args.profile_json)
+
+
+def update_poster_cache(dir, samplers, args):
+    """Add posters for the rungs made in this run, and sample any older rungs that aren't cached yet."""
+    cached = utils.PosterCache([dir])
+    for file in os.listdir(dir):
+        if file.endswith(('.mp4', '.avi', '.MP4', '.AVI')) and re.search(r"\d+x\d+", file):
+            if file not in samplers and utils.clip_key(os.path.basename(os.path.normpath(dir)), file) not in cached:
+                samplers[file] = utils.sample_posters(os.path.join(dir, file), args.poster_thumbnails, args.thumbnail_width)
+    cached.close()
+    if samplers:
+        utils.save_poster_cache(dir, samplers)
+
+
+def save_metrics_summary(dir, rows):
+    """Merge per-file metric summaries into <dir>/quality_metrics.csv, one row per rung."""
+    summary_file = os.path.join(dir, "quality_metrics.csv")
+    df = pd.DataFrame(rows)
+    if os.path.exists(summary_file):
+        df = pd.concat([pd.read_csv(summary_file), df]).drop_duplicates(subset="file", keep="last")
+    df.sort_values(["source", "file"]).to_csv(summary_file, index=False)
+    logger.info(f"Quality metrics for {len(rows)} files saved to {summary_file}")
         
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Set up ultrasound data before running GUI tests.')
     parser.add_argument("--data-directories", type=str, nargs="+", default=["ultrasounds/healthy", "ultrasounds/unhealthy"], help="Directory in which ultrasound videos are located. One path for each label.")
     parser.add_argument("--scale-factors", type=float, nargs="+", default=[0.25, 0.4, 0.55, 0.7, 0.85, 1], help="Specify the resolution compression scales")
+    parser.add_argument("--quality-metrics", action="store_true", help="Compute PSNR and SSIM of each resolution copy against its source while it is written.")
+    parser.add_argument("--metrics-every", type=int, default=5, help="Score every n-th frame when computing quality metrics.")
+    parser.add_argument("--metrics-mode", type=str, choices=utils.METRICS_MODES, default="encoded", help="Score the decoded rung after encoding (includes codec loss) or the resized frames before encoding.")
+    parser.add_argument("--metrics-batch-size", type=int, default=8, help="Number of sampled frames scored together in one vectorized batch.")
+    parser.add_argument("--posters", action="store_true", help="Cache the first frame and slider preview thumbnails of every resolution copy in posters.npz.")
+    parser.add_argument("--poster-thumbnails", type=int, default=10, help="Number of evenly spaced preview thumbnails cached per video.")
+    parser.add_argument("--thumbnail-width", type=int, default=160, help="Width in pixels of the cached preview thumbnails.")
+    parser.add_argument("--pack-archive", type=str, default=None, help="Also pack all resolution copies into this single study archive file.")
+    utils.add_encoder_arguments(parser)
+    utils.add_profiling_arguments(parser)
     
     args = parser.parse_args()
-    main(args)
\ No newline at end of file
+    with utils.maybe_cprofile(args.cprofile):
+        main(args)
\ No newline at end of file
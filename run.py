@@ -9,6 +9,7 @@ import os
 import random
 import re
 import cv2
+import numpy as np
 import pandas as pd
 import logging
 
@@ -19,15 +20,37 @@ from PyQt5.QtWidgets import (
 from PyQt5.QtCore import Qt, QTimer, QEvent
 from PyQt5.QtGui import QPixmap, QImage
 
-from utils import VideoSample, VideoQueue, parse_resolutions
+from validate_data import run_validation
+from utils import (
+    VideoSample, VideoQueue, PosterCache, CapturePool, StudyArchive, ResourceMonitor, CorruptFileException,
+    clip_key, estimate_capture_bytes, estimate_display_bytes, find_rungs, load_session_plan, parse_resolutions, probe_video
+)
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger("Run")
 
 class UltrasoundAssessment(QMainWindow):
-    def __init__(self, video_dir):
+    def __init__(self, video_dir, capture_pool_size=4, archive_path=None, plan=None, reader=None,
+                 memory_budget_mb=None, history_size=None):
         super().__init__()
         self.video_dir = video_dir
-        self.log_file = f"assessment_log_{datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.csv"
+        # clips are read in place from a packed study archive when one is given
+        self.archive = StudyArchive(archive_path) if archive_path else None
+        # a compiled session plan fixes flips and order up front, see plan_sessions.py
+        self.plan = [
+            {**clip, "path": self.resolve_path(clip["path"]), "lookahead": [self.resolve_path(p) for p in clip["lookahead"]]}
+            for clip in plan
+        ] if plan else None
+        self.lookahead = {clip["path"]: clip["lookahead"] for clip in self.plan} if self.plan else {}
+        self.cap = None
+        self.cap_path = None
+        # long-session mode: captures, frame buffers and pixmaps are accounted against a memory budget
+        self.resources = ResourceMonitor(memory_budget_mb)
+        self.frame_buffers = {}
+        reader_prefix = f"{reader}_" if reader else ""
+        self.log_file = f"assessment_log_{reader_prefix}{datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S')}.csv"
         # self.resolutions = resolutions
-        self.previous_videos = deque()
+        self.previous_videos = deque(maxlen=history_size)
         self.current_video = None
         self.current_resolution_idx = 0
         self.video_order = []
@@ -40,29 +63,68 @@ class UltrasoundAssessment(QMainWindow):
         self.selected_reasons = []
 
         self.video_queue = self.get_video_queue()
+        self.videos_by_path = {video.filepath: video for video in self.videos}
+        self.capture_pool = self.create_capture_pool(capture_pool_size)
+        if self.archive:
+            self.poster_cache = PosterCache(archive=self.archive)
+        else:
+            self.poster_cache = PosterCache([os.path.join(self.video_dir, category) for category in ['healthy', 'unhealthy']])
         self.df = self.create_df()
         self.init_ui()
         
+    def resolve_path(self, path):
+        """Plans over an archive list member names, which are resolved against the archive opened here."""
+        return self.archive.virtual_path(path) if self.archive else path
+
+    def create_capture_pool(self, capture_pool_size):
+        opener = self.archive.open_capture if self.archive else cv2.VideoCapture
+        budget = self.resources.budget_bytes
+        if budget is None:
+            return CapturePool(capture_pool_size, opener=opener)
+        # whatever the display of the largest clip may need is reserved, the rest can hold decoders
+        largest = max((video.resolution for video in self.videos), key=lambda r: r[0] * r[1], default=(0, 0))
+        return CapturePool(
+            capture_pool_size, opener=opener,
+            max_bytes=max(0, budget - estimate_display_bytes(largest)),
+            cost=lambda path: estimate_capture_bytes(self.videos_by_path[path].resolution),
+        )
+
     @property
     def current_video_order(self):
         return self.video_queue.size  # Always returns the latest size
 
     def get_video_queue(self):
+        if self.plan:
+            self.videos = [
+                VideoSample(clip["path"], tuple(clip["resolution"]), clip["label"], clip["transform"], clip["order"], clip.get("index", 0))
+                for clip in self.plan
+            ]
+            return VideoQueue(self.videos)
+
+        if self.archive:
+            # the manifest already holds each clip's resolution, nothing needs to be opened
+            self.videos = [
+                VideoSample(self.archive.virtual_path(member), (clip["width"], clip["height"]), clip["label"])
+                for member, clip in self.archive.clips.items()
+            ]
+            return VideoQueue(self.videos)
+
         self.videos = []
-        for category in ['healthy', 'unhealthy']:
-            folder_path = os.path.join(self.video_dir, category)
-            for file in os.listdir(folder_path):
-                if file.endswith(('.mp4', '.MP4', '.AVI', '.avi')):
-                    # only select the processed resolution videos
-                    if re.search(r"\d+x\d+", file):
-                        video_path = os.path.join(folder_path, file)
-                        res_w = cv2.VideoCapture(video_path).get(cv2.CAP_PROP_FRAME_WIDTH)
-                        res_h = cv2.VideoCapture(video_path).get(cv2.CAP_PROP_FRAME_HEIGHT)
-                        # instantiate object
-                        if res_w == 0 or res_h == 0:
-                            raise self.CorruptFileException(f"Corrupt file detected: {video_path}")
-                        video_object = VideoSample(video_path, (res_w, res_h))
-                        self.videos.append(video_object)
+        corrupt_files = []
+        # only select the processed resolution videos
+        for video_path in find_rungs(self.video_dir):
+            cap, info = probe_video(video_path)
+            cap.release()
+            # keep scanning so that every corrupt file is reported at once; unopenable files report -1 sizes
+            if not info["opened"] or info["width"] <= 0 or info["height"] <= 0:
+                corrupt_files.append(video_path)
+                continue
+            # instantiate object
+            video_object = VideoSample(video_path, (info["width"], info["height"]))
+            self.videos.append(video_object)
+
+        if corrupt_files:
+            raise CorruptFileException(f"{len(corrupt_files)} corrupt files detected, run validate_data.py for details: {', '.join(corrupt_files)}")
                     
         video_queue = VideoQueue(self.videos)
         return video_queue
@@ -81,7 +143,7 @@ class UltrasoundAssessment(QMainWindow):
         # self.correct_predictions = {video[0]: 0 for video in self.video_order}
 
     def wheelEvent(self, event):
-        self.slider.valueChanged.connect(self.seek_video_wheel_scroll)
+        # valueChanged is already connected to seek_video_wheel_scroll in init_ui
         # Check the scroll direction: positive for up, negative for down
         delta = event.angleDelta().y()
 
@@ -96,7 +158,6 @@ class UltrasoundAssessment(QMainWindow):
 
         # Prevent further propagation of the event (optional)
         event.accept()
-        self.slider.valueChanged.disconnect(self.seek_video_wheel_scroll)
 
 
     def init_ui(self):
@@ -146,6 +207,15 @@ class UltrasoundAssessment(QMainWindow):
         self.video_order_label = QLabel(str(self.current_video_order))
         self.video_order_label.setStyleSheet("color: gray; font-size: 20px;")
         self.video_order_label.setAlignment(Qt.AlignLeft | Qt.AlignBottom)
+
+        # live resource readout, only shown in long-session mode
+        self.resource_label = QLabel()
+        self.resource_label.setStyleSheet("color: gray; font-size: 14px;")
+        self.resource_label.setVisible(self.resources.budget_mb is not None)
+        self.resource_timer = QTimer(self)
+        self.resource_timer.timeout.connect(self.update_resource_label)
+        if self.resources.budget_mb is not None:
+            self.resource_timer.start(1000)
         
         # buttons
         self.play_btn = QPushButton("Pause")
@@ -271,6 +341,11 @@ class UltrasoundAssessment(QMainWindow):
         self.slider.sliderReleased.connect(self.seek_video_mouse_click)  # Update on release
         self.slider.valueChanged.connect(self.seek_video_wheel_scroll)
         self.slider.setCursor(Qt.PointingHandCursor)
+        # hover previews from the poster cache
+        self.slider.setMouseTracking(True)
+        self.slider.installEventFilter(self)
+        self.preview_label = QLabel(self, Qt.ToolTip)
+        self.preview_label.hide()
         self.slider.setStyleSheet("""
             QSlider::handle:horizontal {
                 background-color: #085a9c;  /* Handle color */
@@ -326,6 +401,7 @@ class UltrasoundAssessment(QMainWindow):
         controls_layout.addWidget(self.play_btn)
         controls_layout.addWidget(self.forward_btn)
         controls_layout.addWidget(self.slider)
+        controls_layout.addWidget(self.resource_label)
 
         # main layout
         main_layout = QVBoxLayout()
@@ -428,13 +504,18 @@ class UltrasoundAssessment(QMainWindow):
             self.selected_reasons.remove(sender.text())
 
     def load_next_video(self, next=True):
+        if not next and not self.previous_videos:
+            return # stay where we are if no previous videos present
         if next:
             self.current_video = self.video_queue.get_next_video() # returns a VideoSample object
         else:
-            if not self.previous_videos:
-                return # stay where we are if no previous videos present
             self.current_video = self.previous_videos.pop()
             
+        # hand the outgoing capture back to the pool, e.g. when Back is pressed during playback
+        self.timer.stop()
+        self.release_capture()
+        self.frame_buffers.clear()
+
         if not self.current_video:
             self.show_end_screen()
             return
@@ -443,12 +524,87 @@ class UltrasoundAssessment(QMainWindow):
         # display index 
         self.video_order_label.setText(str(self.current_video_order))
 
-        self.cap = cv2.VideoCapture(self.current_video.filepath)
+        self.cap_path = self.current_video.filepath
+        self.cap = self.capture_pool.acquire(self.cap_path)
         self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, self.current_video.resolution[0])
         self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, self.current_video.resolution[1])
 
         self.slider.setMaximum(int(self.cap.get(cv2.CAP_PROP_FRAME_COUNT)))
+
+        # paint the cached first frame straight away instead of waiting for the first timer tick
+        poster = self.poster_cache.poster(clip_key(self.current_video.label, self.current_video.filename))
+        if poster is not None:
+            self.video_label.setPixmap(self.frame_to_pixmap(poster))
         self.timer.start(30)
+        # pre-open the clips the plan says come next, after the first frame has been painted
+        QTimer.singleShot(0, self.warm_upcoming)
+
+    def warm_upcoming(self):
+        if not self.current_video:
+            return
+        for path in self.lookahead.get(self.current_video.filepath, []):
+            # sources already identified 3x in a row will be skipped, no need to open them
+            if not self.video_queue.is_retired(self.videos_by_path[path]):
+                self.capture_pool.warm(path)
+
+    def release_capture(self):
+        if self.cap_path is not None:
+            self.capture_pool.release(self.cap_path)
+        self.cap = None
+        self.cap_path = None
+
+    def frame_buffer(self, name, shape):
+        """Reusable frame buffer, so playback doesn't allocate new arrays on every tick."""
+        key = (name, shape)
+        if key not in self.frame_buffers:
+            self.frame_buffers[key] = np.empty(shape, dtype=np.uint8)
+        return self.frame_buffers[key]
+
+    def apply_transform(self, frame):
+        flip_code = {"h_flip": 1, "v_flip": 0, "hv_flip": -1}.get(self.current_video.transform)
+        if flip_code is None:
+            return frame
+        return cv2.flip(frame, flip_code, dst=self.frame_buffer("flip", frame.shape))
+
+    def frame_to_pixmap(self, frame):
+        frame = self.apply_transform(frame)
+        rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB, dst=self.frame_buffer("rgb", frame.shape))
+        h, w, _ = rgb.shape
+        qimg = QImage(rgb.data, w, h, 3 * w, QImage.Format_RGB888)
+        return QPixmap.fromImage(qimg)
+
+    def resource_snapshot(self):
+        pixmaps = [label.pixmap() for label in (self.video_label, self.preview_label)]
+        pixmap_bytes = sum(p.width() * p.height() * p.depth() // 8 for p in pixmaps if p is not None)
+        frame_buffer_bytes = sum(buffer.nbytes for buffer in self.frame_buffers.values())
+        return self.resources.snapshot(self.capture_pool, frame_buffer_bytes, pixmap_bytes)
+
+    def update_resource_label(self):
+        self.resource_label.setText(self.resources.format(self.resource_snapshot()))
+
+    def eventFilter(self, obj, event):
+        if obj is self.slider:
+            if event.type() == QEvent.MouseMove:
+                self.show_preview(event.pos())
+            elif event.type() == QEvent.Leave:
+                self.preview_label.hide()
+        return super().eventFilter(obj, event)
+
+    def show_preview(self, pos):
+        """Show the cached thumbnail nearest to the hovered slider position, without touching the decoder."""
+        if not self.current_video:
+            return
+        frame_idx = QStyle.sliderValueFromPosition(self.slider.minimum(), self.slider.maximum(), pos.x(), self.slider.width())
+        thumbnail = self.poster_cache.thumbnail(clip_key(self.current_video.label, self.current_video.filename), frame_idx)
+        if thumbnail is None:
+            self.preview_label.hide()
+            return
+        pixmap = self.frame_to_pixmap(thumbnail)
+        self.preview_label.setPixmap(pixmap)
+        self.preview_label.resize(pixmap.size())
+        global_pos = self.slider.mapToGlobal(pos)
+        self.preview_label.move(global_pos.x() - pixmap.width() // 2, global_pos.y() - pixmap.height() - 20)
+        self.preview_label.show()
 
     def update_frame(self, set_slider=True):
         ret, frame = self.cap.read()
@@ -456,17 +612,7 @@ class UltrasoundAssessment(QMainWindow):
             self.cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
             return
 
-        if self.current_video.transform == "h_flip":
-            frame = cv2.flip(frame, 1)
-        elif self.current_video.transform == "v_flip":
-            frame = cv2.flip(frame, 0)
-        elif self.current_video.transform == "hv_flip":
-            frame = cv2.flip(frame, -1)
-
-        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        h, w, _ = frame.shape
-        qimg = QImage(frame.data, w, h, QImage.Format_RGB888)
-        self.video_label.setPixmap(QPixmap.fromImage(qimg))
+        self.video_label.setPixmap(self.frame_to_pixmap(frame))
         # avoid recursion with slider value changing by using a flag
         if set_slider:
             self.slider.setValue(int(self.cap.get(cv2.CAP_PROP_POS_FRAMES)))
@@ -552,8 +698,8 @@ class UltrasoundAssessment(QMainWindow):
         self.write_to_csv(prediction)
         
         # wrap up
-        self.cap.release()
         self.timer.stop()
+        self.release_capture()
 
         # reset cant tell button
         self.switch_off_cant_tell()
@@ -566,6 +712,10 @@ class UltrasoundAssessment(QMainWindow):
 
     def show_end_screen(self):
         self.timer.stop()
+        self.resource_timer.stop()
+        self.capture_pool.close()
+        logger.info(self.capture_pool)
+        logger.info(self.resources.format(self.resource_snapshot()))
         self.central_widget.deleteLater()
         end_widget = QWidget()
         layout = QVBoxLayout()
@@ -595,15 +745,40 @@ class UltrasoundAssessment(QMainWindow):
         end_widget.setStyleSheet("background-color: white;")
         self.setCentralWidget(end_widget)
 
+    def closeEvent(self, event):
+        self.timer.stop()
+        self.resource_timer.stop()
+        self.release_capture()
+        self.capture_pool.close()
+        self.poster_cache.close()
+        if self.archive:
+            self.archive.close()
+        super().closeEvent(event)
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Set up ultrasound data before running GUI tests.')
     parser.add_argument("--video_dir", type=str, default="ultrasounds", help="Directory in which ultrasound videos are located.")
+    parser.add_argument("--capture_pool_size", type=int, default=4, help="Number of open video decoders kept for reuse when navigating Back.")
+    parser.add_argument("--validate", action="store_true", help="Check every video before starting and exit if any are broken.")
+    parser.add_argument("--archive", type=str, default=None, help="Packed study archive (from prepare_data.py --pack-archive) to read videos from instead of --video_dir.")
+    parser.add_argument("--plan", type=str, default=None, help="Compiled session plans (from plan_sessions.py) to load instead of scanning and randomising at startup.")
+    parser.add_argument("--reader", type=str, default=None, help="Reader whose plan to run, e.g. reader_1. Required with --plan.")
+    parser.add_argument("--memory_budget_mb", type=float, default=None, help="Long-session mode: keep decoders and display buffers within this budget and show live RSS and handle counts.")
+    parser.add_argument("--history_size", type=int, default=None, help="Number of past videos kept for the Back button, unlimited by default.")
     # parser.add_argument("--resolutions", type=parse_resolutions, default=[(320, 240), (480, 320), (640, 480), (800, 600), (1024, 768), (1280, 720)], help="Specify the resolution for compression, e.g. [(420,300), (800,600)].")
     
     args = parser.parse_args()
+
+    if args.validate and not run_validation(args.video_dir, archive=args.archive):
+        sys.exit(1)
+    if args.plan and not args.reader:
+        parser.error("--reader is required with --plan")
+    plan = load_session_plan(args.plan, args.reader) if args.plan else None
     
     app = QApplication(sys.argv)
-    window = UltrasoundAssessment(args.video_dir)
+    window = UltrasoundAssessment(
+        args.video_dir, args.capture_pool_size, args.archive, plan, args.reader, args.memory_budget_mb, args.history_size
+    )
     window.show()
     sys.exit(app.exec_())
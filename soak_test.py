@@ -0,0 +1,112 @@
+import argparse
+import os
+import sys
+import tempfile
+import cv2
+import logging
+import numpy as np
+import pandas as pd
+
+# must be set before Qt is imported
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from PyQt5.QtWidgets import QApplication
+from PyQt5.QtCore import Qt, QPoint, QPointF
+from PyQt5.QtGui import QWheelEvent
+
+from run import UltrasoundAssessment
+from utils import parse_resolutions
+
+logging.basicConfig(level=logging.WARNING)
+logger = logging.getLogger("Soak Test")
+
+
+def make_synthetic_study(video_dir, num_sources, resolution, num_frames):
+    """
+    Write small noise clips with a resolution suffix, split over healthy/unhealthy. Every clip has the
+    same size, so per-clip memory is constant and any growth over the run is a leak.
+    """
+    rng = np.random.default_rng(0)
+    width, height = resolution
+    for i in range(num_sources):
+        category = "healthy" if i % 2 else "unhealthy"
+        folder_path = os.path.join(video_dir, category)
+        os.makedirs(folder_path, exist_ok=True)
+        out = cv2.VideoWriter(os.path.join(folder_path, f"{i}_{width}x{height}.mp4"), cv2.VideoWriter_fourcc(*'mp4v'), 30, (width, height))
+        for _ in range(num_frames):
+            out.write(rng.integers(0, 255, (height, width, 3), dtype=np.uint8))
+        out.release()
+
+
+def scroll(window, delta):
+    event = QWheelEvent(QPointF(10, 10), QPointF(10, 10), QPoint(0, 0), QPoint(0, delta),
+                        Qt.NoButton, Qt.NoModifier, Qt.NoScrollPhase, False)
+    QApplication.sendEvent(window, event)
+
+
+def main(args):
+    app = QApplication(sys.argv)
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        video_dir = os.path.join(tmp_dir, "ultrasounds")
+        make_synthetic_study(video_dir, args.clips, args.resolution, args.frames)
+
+        # the assessment log is written to the working directory
+        os.chdir(tmp_dir)
+        window = UltrasoundAssessment(video_dir, args.capture_pool_size, memory_budget_mb=args.memory_budget_mb, history_size=args.history_size)
+
+        samples = []
+        for clip in range(args.clips):
+            if window.current_video is None:
+                break
+            for _ in range(args.frames):
+                window.update_frame()
+            scroll(window, 120)
+            scroll(window, -120)
+            if clip % 10 == 5:
+                # Back during playback, then answer the previous clip again
+                window.timer.start(30)
+                window.load_next_video(next=False)
+            # sample while the clip is still on screen, the last one included, before the viewer moves on
+            if clip % args.sample_every == 0 or clip == args.clips - 1:
+                samples.append({"clip": clip, **window.resource_snapshot()})
+            # always answer wrong, so that no source is retired and every clip gets shown
+            window.log_prediction("healthy" if window.current_video.label == "unhealthy" else "unhealthy")
+            app.processEvents()
+        pool_stats = dict(window.capture_pool.stats)
+        window.close()
+        os.chdir(cwd)
+
+    df = pd.DataFrame(samples)
+    print(df[["clip", "rss_mb", "open_handles", "captures", "tracked_mb", "within_budget"]].to_string(index=False))
+
+    # compare the end of the run against the state after warm-up
+    warm = df[df["clip"] >= args.warmup]
+    rss_growth = warm["rss_mb"].iloc[-1] - warm["rss_mb"].iloc[0]
+    handle_growth = warm["open_handles"].iloc[-1] - warm["open_handles"].iloc[0]
+    # the budget, not the pool size, has to be what closes decoders, otherwise the budget isn't exercised
+    budget_bound = pool_stats["evicted"] > 0 and df["captures"].max() < args.capture_pool_size
+    print(f"\n{clip + 1} clips, RSS growth after warm-up {rss_growth:+.1f} MB, handle growth {handle_growth:+d}")
+    print(f"captures opened {pool_stats['opened']}, evicted {pool_stats['evicted']}, at most {df['captures'].max()} open of {args.capture_pool_size}")
+
+    ok = rss_growth <= args.max_rss_growth_mb and handle_growth <= 0 and bool(df["within_budget"].all()) and budget_bound
+    print("PASS" if ok else "FAIL")
+    return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offscreen soak test: drive the viewer through many clips and check that memory stays flat.")
+    parser.add_argument("--clips", type=int, default=500, help="Number of clips to go through.")
+    parser.add_argument("--resolution", type=lambda s: parse_resolutions(s)[0], default=(320, 240), help="Resolution of every synthetic clip, e.g. 320x240.")
+    parser.add_argument("--frames", type=int, default=8, help="Frames per synthetic clip, all of them are played.")
+    parser.add_argument("--capture_pool_size", type=int, default=4, help="Capture pool size used by the viewer.")
+    parser.add_argument("--memory_budget_mb", type=float, default=2.5, help="Memory budget for the long-session mode, small enough that it evicts decoders before the pool size does.")
+    parser.add_argument("--history_size", type=int, default=20, help="Back history kept by the viewer.")
+    parser.add_argument("--warmup", type=int, default=50, help="Clips to go through before measuring growth.")
+    parser.add_argument("--sample_every", type=int, default=25, help="Take a resource snapshot every n clips.")
+    parser.add_argument("--max_rss_growth_mb", type=float, default=4, help="Allowed RSS growth after warm-up.")
+
+    args = parser.parse_args()
+    if args.clips <= args.warmup:
+        parser.error("--clips must be larger than --warmup, growth is measured after warm-up")
+    sys.exit(0 if main(args) else 1)
@@ -1,11 +1,29 @@
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 import os
-from collections import defaultdict, namedtuple
+from collections import OrderedDict, defaultdict, namedtuple
+from contextlib import contextmanager
+import cProfile
 import cv2
 import heapq
+import io
+import json
 import logging
+import mmap
+import numpy as np
+import platform
+import pstats
 import random
 import re
+import shutil
+import struct
+import subprocess
+import time
+import zipfile
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("Utils")
@@ -15,19 +33,32 @@ logger = logging.getLogger("Utils")
 # ===================================
 Video = namedtuple("Video", ["filename", "original_filename", "resolution", "label", "predicted_label", "explanation"])
 
+
+def queue_key(resolution, order=0, index=0):
+    """
+    Serving order of VideoQueue: smallest area first, ties broken by the session plan's source order
+    and finally by the clip's position in the plan, so planned sessions are served exactly as planned.
+    """
+    return resolution[0] * resolution[1], order, index
+
 class VideoSample:
-    def __init__(self, filepath, resolution, label=None):
+    def __init__(self, filepath, resolution, label=None, transform=None, order=0, index=0):
         self.filepath = filepath
         self.resolution = resolution
         self.predicted_label = None
         self.explanation = None
+        # tie-breaks between videos of the same resolution, set by session plans
+        self.order = order
+        self.index = index
 
         self.filename = self.filepath.split('/')[-1]
         self.label = label if label else self.get_label()
         # self.transform = random.choice(['none', 'h_flip', 'v_flip', 'hv_flip'])
         # self.transform = 'none'
-        self.transform = random.choice(['none', 'v_flip'])
+        self.transform = transform if transform else random.choice(['none', 'v_flip'])
         self.original_filename = os.path.basename(self.filepath).split("_")[0] + ".mp4" # extract the name before the suffix, with .mp4 at the end
+        # the same source name can exist under both labels, the queue tracks rungs per labelled source
+        self.source = clip_key(self.label, self.original_filename)
 
     def get_label(self):
         return os.path.basename(os.path.dirname(self.filepath))
@@ -39,7 +70,7 @@ class VideoSample:
     def __lt__(self, other):
         if not isinstance(other, VideoSample):
             return NotImplemented
-        return (self.resolution[0]*self.resolution[1]) < (other.resolution[0]*other.resolution[1])
+        return queue_key(self.resolution, self.order, self.index) < queue_key(other.resolution, other.order, other.index)
 
 class VideoQueue:
     def __init__(self, videos):
@@ -49,40 +80,719 @@ class VideoQueue:
         self.successful_predictions = defaultdict(int) 
 
         for video in self.videos:
-            heapq.heappush(self.heap, (video.resolution, video)) 
+            heapq.heappush(self.heap, (queue_key(video.resolution, video.order, video.index), video))
         self.size = len(self.heap)
 
     def get_next_video(self):
         """Fetch the next video to process based on priority."""
         while self.heap:
-            resolution, video = heapq.heappop(self.heap)
+            _, video = heapq.heappop(self.heap)
+            resolution = video.resolution
             self.size = len(self.heap)
 
             # Skip videos with successful predictions >= 3
-            if self.successful_predictions[video.original_filename] >= 3:
+            if self.is_retired(video):
                 video.predicted_label = "N/A"
                 video.explanation = "Lower resolutions predicted successfully 3x"
                 # print(f"Discarding higher resolution: {video}")
                 continue
 
             # Check if all lower resolutions have been processed
-            if all(res[0]*res[1] < resolution[0]*resolution[1] for res in self.processed_resolutions[video.original_filename]):
-                self.processed_resolutions[video.original_filename].add(resolution)
+            if all(res[0]*res[1] < resolution[0]*resolution[1] for res in self.processed_resolutions[video.source]):
+                self.processed_resolutions[video.source].add(resolution)
                 return video
 
         return None
 
+    def is_retired(self, video):
+        """True once a video's source has been identified 3x in a row, so its remaining rungs will be skipped."""
+        return self.successful_predictions[video.source] >= 3
+
     def update_predictions(self, video, predicted_label):
         """Update the video with predicted label."""
         video.predicted_label = predicted_label
         
         if video.label == predicted_label:
-            self.successful_predictions[video.original_filename] += 1
+            self.successful_predictions[video.source] += 1
         else:
-            self.successful_predictions[video.original_filename] = 0  # Reset if prediction fails
+            self.successful_predictions[video.source] = 0  # Reset if prediction fails
 
         return video
 
+# ===================================
+# CAPTURE POOL
+# ===================================
+class CapturePool:
+    """
+    Bounded pool of open cv2.VideoCapture handles keyed by file path.
+
+    A handle is either in use (acquired and not yet released) or idle. Released handles stay open so
+    that going Back to a recent clip reuses a warm decoder; once more than `max_size` handles are open,
+    or their estimated memory exceeds `max_bytes`, idle ones are closed in least-recently-used order.
+    Handles in use are never evicted. `cost(path)` estimates the memory of one open handle.
+    """
+    def __init__(self, max_size=4, opener=cv2.VideoCapture, max_bytes=None, cost=None):
+        self.max_size = max_size
+        self.opener = opener
+        self.max_bytes = max_bytes
+        self.cost = cost or (lambda path: 0)
+        self.idle = OrderedDict()  # least recently used first
+        self.in_use = {}
+        self.costs = {}
+        self.stats = defaultdict(int)
+
+    @property
+    def bytes(self):
+        """Estimated memory held by all open handles."""
+        return sum(self.costs.values())
+
+    def __len__(self):
+        return len(self.idle) + len(self.in_use)
+
+    def acquire(self, path):
+        """Return an open capture for path, rewound to the first frame."""
+        if path in self.in_use:
+            cap = self.in_use[path]
+        else:
+            cap = self.idle.pop(path, None)
+            if cap is not None and cap.isOpened():
+                self.stats["reused"] += 1
+            else:
+                if cap is not None:
+                    cap.release()
+                cap = self._open(path)
+            self.in_use[path] = cap
+            self._evict()
+        cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+        return cap
+
+    def warm(self, path):
+        """Open a capture ahead of time so a later acquire reuses it. Already open paths are left alone."""
+        if path in self.in_use or path in self.idle:
+            return
+        self.idle[path] = self._open(path)
+        self.stats["warmed"] += 1
+        self._evict()
+
+    def _open(self, path):
+        self.stats["opened"] += 1
+        self.costs[path] = self.cost(path)
+        return self.opener(path)
+
+    def release(self, path):
+        """Hand a capture back to the pool. It stays open until evicted or the pool is closed."""
+        cap = self.in_use.pop(path, None)
+        if cap is None:
+            return
+        self.idle[path] = cap
+        self._evict()
+
+    def _over_budget(self):
+        return len(self) > self.max_size or (self.max_bytes is not None and self.bytes > self.max_bytes)
+
+    def _evict(self):
+        while self._over_budget() and self.idle:
+            path, cap = self.idle.popitem(last=False)
+            cap.release()
+            self.costs.pop(path, None)
+            self.stats["closed"] += 1
+            self.stats["evicted"] += 1
+
+    def close(self):
+        for cap in list(self.idle.values()) + list(self.in_use.values()):
+            cap.release()
+            self.stats["closed"] += 1
+        self.idle.clear()
+        self.in_use.clear()
+        self.costs.clear()
+
+    def __repr__(self):
+        return (f"CapturePool(open={len(self)}, in_use={len(self.in_use)}, max_size={self.max_size}, "
+                f"opened={self.stats['opened']}, reused={self.stats['reused']}, closed={self.stats['closed']})")
+
+# ===================================
+# RESOURCE ACCOUNTING
+# ===================================
+# rough decoder footprint: a few YUV420 reference frames plus the BGR frame handed back by read()
+CAPTURE_BUFFER_FRAMES = 4
+
+
+def estimate_capture_bytes(resolution):
+    width, height = resolution
+    return int(width * height * (1.5 * CAPTURE_BUFFER_FRAMES + 3))
+
+
+def estimate_display_bytes(resolution):
+    """Per-clip display memory: flip and RGB frame buffers (3 bytes/px each) and the shown pixmap (4 bytes/px)."""
+    width, height = resolution
+    return int(width * height * (3 + 3 + 4))
+
+
+class ResourceMonitor:
+    """
+    Live process measurements (RSS, open file handles) next to the viewer's own accounting of captures,
+    frame buffers and pixmaps, checked against an optional memory budget in MB.
+    """
+    def __init__(self, budget_mb=None):
+        self.budget_mb = budget_mb
+
+    @property
+    def budget_bytes(self):
+        return None if self.budget_mb is None else int(self.budget_mb * 2 ** 20)
+
+    @staticmethod
+    def rss_mb():
+        """Current resident set size; falls back to the peak where /proc isn't available, None on Windows."""
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+        except (OSError, ValueError, AttributeError):
+            pass
+        if resource is None:
+            return None
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in bytes on macOS and in KB elsewhere
+        return peak / 2 ** 20 if platform.system() == "Darwin" else peak / 2 ** 10
+
+    @staticmethod
+    def open_handles():
+        for fd_dir in ("/proc/self/fd", "/dev/fd"):
+            try:
+                return len(os.listdir(fd_dir))
+            except OSError:
+                continue
+        return None
+
+    def snapshot(self, capture_pool, frame_buffer_bytes=0, pixmap_bytes=0):
+        tracked = capture_pool.bytes + frame_buffer_bytes + pixmap_bytes
+        return {
+            "rss_mb": self.rss_mb(),
+            "open_handles": self.open_handles(),
+            "captures": len(capture_pool),
+            "captures_mb": capture_pool.bytes / 2 ** 20,
+            "frame_buffers_mb": frame_buffer_bytes / 2 ** 20,
+            "pixmaps_mb": pixmap_bytes / 2 ** 20,
+            "tracked_mb": tracked / 2 ** 20,
+            "within_budget": self.budget_bytes is None or tracked <= self.budget_bytes,
+        }
+
+    def format(self, snapshot):
+        rss = "n/a" if snapshot["rss_mb"] is None else f"{snapshot['rss_mb']:.0f} MB"
+        handles = "n/a" if snapshot["open_handles"] is None else snapshot["open_handles"]
+        budget = "" if self.budget_mb is None else f" / {self.budget_mb:.0f} MB"
+        return (f"RSS {rss} | handles {handles} | captures {snapshot['captures']} | "
+                f"tracked {snapshot['tracked_mb']:.1f} MB{budget}")
+
+# ===================================
+# DATASET VALIDATION
+# ===================================
+VIDEO_EXTENSIONS = ('.mp4', '.MP4', '.AVI', '.avi')
+
+
+class CorruptFileException(Exception):
+    pass
+
+
+def find_source(rung_path):
+    """Return the original video a resolution copy was made from, or None if it isn't next to it."""
+    rung_dir, rung_name = os.path.split(rung_path)
+    source_base = re.sub(r"_\d+x\d+$", "", os.path.splitext(rung_name)[0])
+    for ext in VIDEO_EXTENSIONS:
+        candidate = os.path.join(rung_dir, source_base + ext)
+        if os.path.exists(candidate):
+            return candidate
+    return None
+
+
+def probe_video(path, opener=cv2.VideoCapture):
+    """Read the container header of a video without decoding frames."""
+    cap = opener(path)
+    info = {
+        "opened": cap.isOpened(),
+        "width": int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+        "height": int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+        "fps": cap.get(cv2.CAP_PROP_FPS),
+        "frame_count": int(cap.get(cv2.CAP_PROP_FRAME_COUNT)),
+    }
+    return cap, info
+
+
+def _check_frames(cap, info, file, num_sample_frames, issues):
+    """Header sanity, a sample of decodable frames spread over the clip, and the _WxH suffix against the frame size."""
+    if info["width"] == 0 or info["height"] == 0 or info["frame_count"] <= 0 or info["fps"] <= 0:
+        issues.append("empty or corrupt header")
+
+    decoded = 0
+    frame_size = None
+    positions = np.linspace(0, max(info["frame_count"] - 1, 0), num_sample_frames).round().astype(int)
+    for position in sorted(set(positions.tolist())):
+        cap.set(cv2.CAP_PROP_POS_FRAMES, position)
+        ret, frame = cap.read()
+        if ret:
+            decoded += 1
+            frame_size = (frame.shape[1], frame.shape[0])
+        else:
+            issues.append(f"frame {position} not decodable")
+    cap.release()
+
+    suffix = re.search(r"_(\d+)x(\d+)$", os.path.splitext(file)[0])
+    if suffix is None:
+        issues.append("no resolution suffix")
+    else:
+        expected = (int(suffix.group(1)), int(suffix.group(2)))
+        if frame_size is not None and frame_size != expected:
+            issues.append(f"suffix {expected[0]}x{expected[1]} but frames are {frame_size[0]}x{frame_size[1]}")
+    return decoded
+
+
+def validate_rung(path, num_sample_frames=5, frame_tolerance=1, fps_tolerance=0.01):
+    """
+    Check one resolution copy: header, a sample of decodable frames spread over the clip, frame count
+    and fps against its source, and that the _WxH suffix matches the decoded frame size.
+    Returns a report row; `issues` is empty for a healthy file.
+    """
+    issues = []
+    record = {"file": os.path.basename(path), "label": os.path.basename(os.path.dirname(path)), "path": path}
+
+    if os.path.getsize(path) == 0:
+        return {**record, "ok": False, "issues": "zero-size file"}
+
+    cap, info = probe_video(path)
+    record.update({k: info[k] for k in ("width", "height", "fps", "frame_count")})
+    if not info["opened"]:
+        cap.release()
+        return {**record, "ok": False, "issues": "cannot open"}
+    record["sampled_frames_decoded"] = _check_frames(cap, info, record["file"], num_sample_frames, issues)
+
+    source = find_source(path)
+    if source is None:
+        issues.append("source video not found")
+    else:
+        source_cap, source_info = probe_video(source)
+        source_cap.release()
+        record["source"] = os.path.basename(source)
+        if abs(source_info["frame_count"] - info["frame_count"]) > frame_tolerance:
+            issues.append(f"frame count {info['frame_count']} vs {source_info['frame_count']} in source")
+        if abs(source_info["fps"] - info["fps"]) > fps_tolerance:
+            issues.append(f"fps {info['fps']:.2f} vs {source_info['fps']:.2f} in source")
+
+    return {**record, "ok": not issues, "issues": "; ".join(issues)}
+
+
+def find_rungs(video_dir, categories=("healthy", "unhealthy")):
+    """All processed resolution copies (files with a WxH suffix) under each category folder."""
+    rungs = []
+    for category in categories:
+        folder_path = os.path.join(video_dir, category)
+        for file in sorted(os.listdir(folder_path)):
+            if file.endswith(VIDEO_EXTENSIONS) and re.search(r"\d+x\d+", file):
+                rungs.append(os.path.join(folder_path, file))
+    return rungs
+
+
+def validate_dataset(video_dir, workers=None, num_sample_frames=5):
+    """
+    Validate every rung in parallel. OpenCV releases the GIL while opening and decoding, so a thread
+    pool keeps all cores busy without pickling frames between processes.
+    """
+    def check(path):
+        try:
+            return validate_rung(path, num_sample_frames)
+        except Exception as e:
+            return {"file": os.path.basename(path), "label": os.path.basename(os.path.dirname(path)), "path": path,
+                    "ok": False, "issues": f"validation error: {e}"}
+
+    rungs = find_rungs(video_dir)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(check, rungs))
+
+# ===================================
+# STUDY ARCHIVE
+# ===================================
+# Layout: magic | clips, each aligned to ARCHIVE_ALIGNMENT | JSON manifest | footer (manifest offset, magic).
+# Clips are stored uncompressed, byte for byte, so they can be decoded straight from their offset.
+ARCHIVE_MAGIC = b"MINRES01"
+ARCHIVE_ALIGNMENT = 4096
+_ARCHIVE_FOOTER = struct.Struct("<Q8s")
+
+
+def write_archive(archive_path, data_directories):
+    """
+    Pack every rung in the label directories into one archive, members named <label>/<file>. Each
+    directory's poster cache is packed alongside, so the viewer can paint posters in archive mode too.
+    """
+    clips = []
+    posters = []
+    with open(archive_path, "wb") as archive:
+        archive.write(ARCHIVE_MAGIC)
+        for dir in data_directories:
+            dir = os.path.normpath(dir)
+            for path in find_rungs(os.path.dirname(dir), [os.path.basename(dir)]):
+                cap, info = probe_video(path)
+                cap.release()
+                archive.write(b"\0" * (-archive.tell() % ARCHIVE_ALIGNMENT))
+                offset = archive.tell()
+                with open(path, "rb") as clip:
+                    shutil.copyfileobj(clip, archive, 1024 * 1024)
+                label = os.path.basename(dir)
+                clips.append({
+                    "path": f"{label}/{os.path.basename(path)}", "label": label,
+                    "offset": offset, "size": archive.tell() - offset,
+                    **{k: info[k] for k in ("width", "height", "fps", "frame_count")},
+                })
+            cache_file = os.path.join(dir, POSTER_CACHE_FILE)
+            if os.path.exists(cache_file):
+                archive.write(b"\0" * (-archive.tell() % ARCHIVE_ALIGNMENT))
+                offset = archive.tell()
+                with open(cache_file, "rb") as cache:
+                    shutil.copyfileobj(cache, archive, 1024 * 1024)
+                posters.append({"label": os.path.basename(dir), "offset": offset, "size": archive.tell() - offset})
+        manifest_offset = archive.tell()
+        archive.write(json.dumps({"version": 1, "clips": clips, "posters": posters}).encode())
+        archive.write(_ARCHIVE_FOOTER.pack(manifest_offset, ARCHIVE_MAGIC))
+    logger.info(f"Packed {len(clips)} videos and {len(posters)} poster caches into {archive_path}")
+
+
+class _ArchiveStream(io.BufferedIOBase):
+    """
+    One clip of the archive as a seekable binary stream over the memory map. OpenCV's stream-based
+    VideoCapture accepts io.BufferedIOBase objects and pulls bytes through read and seek.
+    """
+    def __init__(self, mm, offset, size):
+        super().__init__()
+        self.mm = mm
+        self.start = offset
+        self.size = size
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.size - self.pos
+        n = max(0, min(size, self.size - self.pos))
+        data = self.mm[self.start + self.pos:self.start + self.pos + n]
+        self.pos += n
+        return data
+
+    def readinto(self, buf):
+        data = self.read(len(buf))
+        buf[:len(data)] = data
+        return len(data)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self.pos, io.SEEK_END: self.size}[whence]
+        self.pos = min(max(0, base + offset), self.size)
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+
+class _ArchiveCapture:
+    """
+    VideoCapture reading from an _ArchiveStream. VideoCapture.release() destroys the Python stream
+    without holding the GIL on current OpenCV builds and crashes the interpreter, so release() here
+    drops the capture and lets it be deallocated normally instead.
+    """
+    def __init__(self, cap):
+        self._cap = cap
+
+    def __getattr__(self, name):
+        return getattr(self._cap, name)
+
+    def isOpened(self):
+        return self._cap is not None and self._cap.isOpened()
+
+    def release(self):
+        self._cap = None
+
+
+class StudyArchive:
+    """
+    Read side of a packed study. Opening it reads only the footer and manifest; clips are decoded in
+    place through a read-only memory map (OpenCV >= 4.11 stream API), or through ffmpeg's subfile
+    protocol on older builds. The manifest is keyed by member name <label>/<file>, so plans stay valid
+    wherever the archive is opened from. The viewer addresses clips by virtual paths
+    <archive>/<label>/<file>, from which VideoSample derives filename and label exactly as for loose files.
+    """
+    def __init__(self, archive_path):
+        self.archive_path = archive_path
+        self.file = open(archive_path, "rb")
+        self.file.seek(-_ARCHIVE_FOOTER.size, os.SEEK_END)
+        footer_offset = self.file.tell()
+        manifest_offset, magic = _ARCHIVE_FOOTER.unpack(self.file.read(_ARCHIVE_FOOTER.size))
+        if magic != ARCHIVE_MAGIC:
+            raise CorruptFileException(f"{archive_path} is not a study archive")
+        self.file.seek(manifest_offset)
+        self.manifest = json.loads(self.file.read(footer_offset - manifest_offset))
+        self.clips = {clip["path"]: clip for clip in self.manifest["clips"]}
+        self.mmap = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def virtual_path(self, member):
+        return f"{self.archive_path}/{member}"
+
+    def member(self, path):
+        """Member name of a virtual path; member names are returned unchanged."""
+        prefix = f"{self.archive_path}/"
+        return path[len(prefix):] if path.startswith(prefix) else path
+
+    def open_capture(self, path):
+        """cv2.VideoCapture for a clip, by virtual path or member name, usable as a CapturePool opener."""
+        clip = self.clips[self.member(path)]
+        try:
+            return _ArchiveCapture(cv2.VideoCapture(_ArchiveStream(self.mmap, clip["offset"], clip["size"]), cv2.CAP_FFMPEG, []))
+        except cv2.error:
+            # OpenCV builds without the stream API
+            start, end = clip["offset"], clip["offset"] + clip["size"]
+            return cv2.VideoCapture(f"subfile,,start,{start},end,{end},,:{self.archive_path}", cv2.CAP_FFMPEG)
+
+    def open_posters(self):
+        """The packed poster caches as (label, NpzFile) pairs, read lazily from the memory map."""
+        return [
+            (entry["label"], np.load(_ArchiveStream(self.mmap, entry["offset"], entry["size"])))
+            for entry in self.manifest.get("posters", [])
+        ]
+
+    def close(self):
+        self.mmap.close()
+        self.file.close()
+
+
+def validate_archive_member(archive, member, num_sample_frames=5):
+    """
+    Check one archive clip the way validate_rung checks a loose file. Sources aren't packed, so the
+    decoded header is compared against the manifest instead of against the source video.
+    """
+    issues = []
+    clip = archive.clips[member]
+    record = {"file": os.path.basename(member), "label": clip["label"], "path": archive.virtual_path(member)}
+
+    if clip["size"] == 0:
+        return {**record, "ok": False, "issues": "zero-size file"}
+
+    cap, info = probe_video(member, archive.open_capture)
+    record.update({k: info[k] for k in ("width", "height", "fps", "frame_count")})
+    if not info["opened"]:
+        cap.release()
+        return {**record, "ok": False, "issues": "cannot open"}
+    record["sampled_frames_decoded"] = _check_frames(cap, info, record["file"], num_sample_frames, issues)
+
+    for key in ("width", "height", "frame_count"):
+        if info[key] != clip[key]:
+            issues.append(f"{key} {info[key]} vs {clip[key]} in manifest")
+    if abs(info["fps"] - clip["fps"]) > 0.01:
+        issues.append(f"fps {info['fps']:.2f} vs {clip['fps']:.2f} in manifest")
+
+    return {**record, "ok": not issues, "issues": "; ".join(issues)}
+
+
+def validate_archive(archive_path, workers=None, num_sample_frames=5):
+    """Validate every clip of a study archive in parallel, decoding in place like the viewer does."""
+    archive = StudyArchive(archive_path)
+
+    def check(member):
+        try:
+            return validate_archive_member(archive, member, num_sample_frames)
+        except Exception as e:
+            return {"file": os.path.basename(member), "label": archive.clips[member]["label"],
+                    "path": archive.virtual_path(member), "ok": False, "issues": f"validation error: {e}"}
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(check, archive.clips))
+    finally:
+        archive.close()
+
+# ===================================
+# PROFILING
+# ===================================
+class _StageRecord:
+    __slots__ = ("frames",)
+
+    def __init__(self, frames):
+        self.frames = frames
+
+
+class StageProfiler:
+    """
+    Opt-in stage timer for the preparation pipeline. Wall time and frame counts are accumulated per
+    (file, rung, stage), and every file/rung span is kept as a trace event. A disabled profiler hands
+    out no-op stages, so instrumented loops don't need to branch on it.
+    """
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.totals = {}  # (file, rung, stage) -> [seconds, frames], a plain dict so it pickles across processes
+        self.events = []
+        self.file = ""
+        self.rung = ""
+
+    @contextmanager
+    def span(self, file, rung):
+        """Attribute the stages timed inside the block to one file and rung."""
+        self.file, self.rung = os.path.basename(str(file)), rung
+        # spans are placed on the wall clock, which all worker processes share, and measured with perf_counter
+        wall_start = time.time_ns()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.enabled:
+                self.events.append({
+                    "name": f"{self.file} {rung}", "ph": "X", "pid": os.getpid(), "tid": 0,
+                    "ts": wall_start / 1e3, "dur": (time.perf_counter() - start) * 1e6,
+                })
+
+    @contextmanager
+    def stage(self, name, frames=1):
+        """Time one stage call. Set .frames on the yielded record if the call did not process a frame."""
+        record = _StageRecord(frames)
+        if not self.enabled:
+            yield record
+            return
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            total = self.totals.setdefault((self.file, self.rung, name), [0.0, 0])
+            total[0] += time.perf_counter() - start
+            total[1] += record.frames
+
+    def merge(self, other):
+        """Fold in the results of a profiler that ran in a worker process."""
+        for key, (seconds, frames) in other.totals.items():
+            total = self.totals.setdefault(key, [0.0, 0])
+            total[0] += seconds
+            total[1] += frames
+        self.events.extend(other.events)
+
+    def rows(self):
+        return [
+            {"file": file, "rung": rung, "stage": stage, "seconds": seconds, "frames": frames,
+             "ms_per_frame": 1000 * seconds / frames if frames else None}
+            for (file, rung, stage), (seconds, frames) in sorted(self.totals.items())
+        ]
+
+    def summary(self):
+        """Per-stage totals over all files and rungs, slowest first, as a printable table."""
+        stages = defaultdict(lambda: [0.0, 0])
+        for (_, _, stage), (seconds, frames) in self.totals.items():
+            stages[stage][0] += seconds
+            stages[stage][1] += frames
+        total_seconds = sum(seconds for seconds, _ in stages.values()) or 1.0
+        lines = [f"{'stage':<12}{'seconds':>10}{'frames':>10}{'ms/frame':>10}{'share':>8}"]
+        for stage, (seconds, frames) in sorted(stages.items(), key=lambda item: -item[1][0]):
+            ms_per_frame = f"{1000 * seconds / frames:.3f}" if frames else "-"
+            lines.append(f"{stage:<12}{seconds:>10.2f}{frames:>10}{ms_per_frame:>10}{seconds / total_seconds:>8.1%}")
+        return "\n".join(lines)
+
+    def save(self, path):
+        """
+        Write the totals and the spans as JSON. `traceEvents` follows the Chrome trace format, so the
+        file also opens in chrome://tracing or Perfetto; `machine` makes runs on different hosts comparable.
+        """
+        trace = {
+            "machine": {
+                "platform": platform.platform(), "processor": platform.processor(), "cpu_count": os.cpu_count(),
+                "python": platform.python_version(), "opencv": cv2.__version__, "opencv_threads": cv2.getNumThreads(),
+            },
+            "stages": self.rows(),
+            "traceEvents": self.events,
+        }
+        with open(path, "w") as f:
+            json.dump(trace, f, indent=1)
+        logger.info(f"Profile trace saved at {path}")
+
+
+def add_profiling_arguments(parser):
+    """Register the shared profiling options on an argparse parser."""
+    group = parser.add_argument_group("profiling")
+    group.add_argument("--profile", action="store_true", help="Time each processing stage and print a summary table.")
+    group.add_argument("--profile-json", type=str, default=None, help="Save per-file, per-rung stage timings and a trace as JSON (implies --profile).")
+    group.add_argument("--cprofile", type=str, default=None, help="Also run under cProfile and save the stats to this file.")
+
+
+@contextmanager
+def maybe_cprofile(path, top=25):
+    """Run the block under cProfile when a path is given, then save the stats and log the top functions."""
+    if not path:
+        yield
+        return
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        profile.dump_stats(path)
+        pstats.Stats(profile).sort_stats("cumulative").print_stats(top)
+        logger.info(f"cProfile stats saved at {path}")
+
+# ===================================
+# SESSION PLANS
+# ===================================
+def source_name(path):
+    """The original video a rung belongs to, named the same way as VideoSample.original_filename."""
+    return os.path.basename(path).split("_")[0] + ".mp4"
+
+
+def compile_session_plans(catalog, num_readers, seed=0, lookahead=2):
+    """
+    Precompute reproducible, counterbalanced viewing plans for `num_readers` readers in one pass.
+
+    `catalog` is a list of dicts with path, resolution and label. All randomness comes from `seed`:
+    - flips: half of the clips are flipped for each reader, and consecutive readers see complementary
+      flips, so every clip is shown flipped and unflipped equally often across reader pairs.
+    - order: sources get a seeded base order, rotated by an equal step per reader (a Latin-square style
+      design), so each source appears early for some readers and late for others. All rungs of a source
+      share its rank, which VideoSample uses to break ties between videos of the same resolution. Sources
+      are told apart by clip_key(label, source), since the same file name can exist under both labels.
+    - index: each clip's position in the plan, the final tie-break, so the queue serves the plan as is.
+    - lookahead: each clip lists the clips that follow it in plan order, for the viewer to pre-open.
+    """
+    rng = random.Random(seed)
+    catalog = sorted(catalog, key=lambda clip: clip["path"])
+
+    flips = [i % 2 for i in range(len(catalog))]
+    rng.shuffle(flips)
+    sources = sorted({clip_key(clip["label"], source_name(clip["path"])) for clip in catalog})
+    rng.shuffle(sources)
+
+    plans = []
+    for reader in range(num_readers):
+        shift = reader * len(sources) // max(num_readers, 1)
+        rank = {source: (i - shift) % len(sources) for i, source in enumerate(sources)}
+        clips = [
+            {
+                "path": clip["path"], "resolution": list(clip["resolution"]), "label": clip["label"],
+                "transform": "v_flip" if flip ^ (reader % 2) else "none",
+                "order": rank[clip_key(clip["label"], source_name(clip["path"]))],
+            }
+            for clip, flip in zip(catalog, flips)
+        ]
+        # the order VideoQueue serves clips in when none are skipped, a stable sort keeps it deterministic
+        clips.sort(key=lambda c: queue_key(c["resolution"], c["order"]))
+        for i, clip in enumerate(clips):
+            clip["index"] = i
+            clip["lookahead"] = [c["path"] for c in clips[i + 1:i + 1 + lookahead]]
+        plans.append({"reader": f"reader_{reader + 1}", "clips": clips})
+
+    return {"version": 1, "seed": seed, "lookahead": lookahead, "readers": plans}
+
+
+def load_session_plan(plan_file, reader):
+    """Return the clip list of one reader from a compiled plan file."""
+    with open(plan_file) as f:
+        plan = json.load(f)
+    for reader_plan in plan["readers"]:
+        if reader_plan["reader"] == reader:
+            return reader_plan["clips"]
+    raise ValueError(f"Reader <{reader}> not in {plan_file}, available: {[r['reader'] for r in plan['readers']]}")
+
 # ===================================
 # ARGS UTILITY
 # ===================================
@@ -102,10 +812,483 @@ def parse_resolutions(res_str):
         raise argparse.ArgumentTypeError(
             "Resolutions must be a comma-separated list of WIDTHxHEIGHT pairs, e.g., '320x240,480x320'")
     
+# ===================================
+# VIDEO ENCODING
+# ===================================
+ENCODER_BACKENDS = ("opencv", "ffmpeg")
+
+# crf and bitrate are mutually exclusive; bitrate (e.g. "2M") wins when both are given
+EncoderSettings = namedtuple(
+    "EncoderSettings",
+    ["backend", "codec", "crf", "bitrate", "preset", "gop", "pix_fmt", "threads"],
+    defaults=["opencv", None, None, None, None, None, "yuv420p", 0],
+)
+
+
+class OpenCVEncoder:
+    """
+    Thin wrapper around cv2.VideoWriter. Only the codec (fourcc) can be controlled; quality, preset,
+    GOP, pixel format and encoder threads are decided by OpenCV's own build.
+    """
+    def __init__(self, output_file, fps, size, settings):
+        self.output_file = output_file
+        if settings.crf is not None or settings.bitrate or settings.preset or settings.gop or settings.threads:
+            logger.warning("OpenCV backend ignores crf/bitrate/preset/gop/threads settings, use --encoder ffmpeg to control them.")
+        fourcc = cv2.VideoWriter_fourcc(*(settings.codec or 'mp4v'))
+        self.writer = cv2.VideoWriter(output_file, fourcc, fps, size)
+        if not self.writer.isOpened():
+            raise RuntimeError(f"Could not open VideoWriter for {output_file}")
+
+    def write(self, frame):
+        self.writer.write(frame)
+
+    def release(self):
+        self.writer.release()
+
+
+class FFmpegEncoder:
+    """
+    Pipes raw BGR frames into an ffmpeg subprocess, which gives full control over the codec,
+    rate control (CRF or bitrate), preset, GOP length, pixel format and thread count.
+    """
+    def __init__(self, output_file, fps, size, settings):
+        ffmpeg = shutil.which("ffmpeg")
+        if ffmpeg is None:
+            raise RuntimeError("ffmpeg backend requested but no ffmpeg executable found on PATH")
+        self.output_file = output_file
+        width, height = size
+
+        cmd = [
+            ffmpeg, "-y", "-loglevel", "error",
+            "-f", "rawvideo", "-pix_fmt", "bgr24", "-s", f"{width}x{height}", "-r", f"{fps}",
+            "-i", "-",
+            "-an", "-c:v", settings.codec or "libx264",
+        ]
+        if settings.bitrate:
+            cmd += ["-b:v", str(settings.bitrate)]
+        else:
+            cmd += ["-crf", str(23 if settings.crf is None else settings.crf)]
+        if settings.preset:
+            cmd += ["-preset", settings.preset]
+        if settings.gop:
+            cmd += ["-g", str(settings.gop)]
+        if settings.pix_fmt:
+            cmd += ["-pix_fmt", settings.pix_fmt]
+            if settings.pix_fmt == "yuv420p" and (width % 2 or height % 2):
+                # chroma subsampling needs even dimensions, pad by one pixel rather than failing. Resolution
+                # copies are always even (see even_resolution), so this only affects crops with odd margins.
+                cmd += ["-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2"]
+        cmd += ["-threads", str(settings.threads or 0)]
+        if output_file.lower().endswith((".mp4", ".mov")):
+            # moov atom up front so the viewer can start decoding without reading to the end of the file
+            cmd += ["-movflags", "+faststart"]
+        cmd.append(output_file)
+
+        self.process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def write(self, frame):
+        try:
+            self.process.stdin.write(frame.tobytes())
+        except BrokenPipeError:
+            # ffmpeg exited early, e.g. on an unknown codec, preset or pixel format
+            raise RuntimeError(f"ffmpeg failed for {self.output_file}: {self._finish()}") from None
+
+    def _finish(self):
+        """Close the pipe, wait for ffmpeg and return its stderr text."""
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        stderr = self.process.stderr.read()
+        self.process.stderr.close()
+        self.process.wait()
+        return stderr.decode(errors='replace')
+
+    def release(self):
+        stderr = self._finish()
+        if self.process.returncode != 0:
+            raise RuntimeError(f"ffmpeg failed for {self.output_file}: {stderr}")
+
+
+def make_encoder(output_file, fps, size, settings=None):
+    """Create a frame encoder with the cv2.VideoWriter interface (write/release) for the chosen backend."""
+    settings = settings or EncoderSettings()
+    if settings.backend == "opencv":
+        return OpenCVEncoder(output_file, fps, size, settings)
+    elif settings.backend == "ffmpeg":
+        return FFmpegEncoder(output_file, fps, size, settings)
+    raise ValueError(f"Unknown encoder backend <{settings.backend}>, expected one of {ENCODER_BACKENDS}")
+
+
+def add_encoder_arguments(parser):
+    """Register the shared encoder options on an argparse parser."""
+    group = parser.add_argument_group("encoder")
+    group.add_argument("--encoder", type=str, choices=ENCODER_BACKENDS, default="opencv", help="Backend used to write videos.")
+    group.add_argument("--codec", type=str, default=None, help="Codec: a fourcc for opencv (default mp4v), an ffmpeg encoder name for ffmpeg (default libx264).")
+    group.add_argument("--crf", type=int, default=None, help="Constant rate factor (ffmpeg only, default 23).")
+    group.add_argument("--bitrate", type=str, default=None, help="Target bitrate, e.g. 2M. Overrides --crf (ffmpeg only).")
+    group.add_argument("--preset", type=str, default=None, help="Encoder preset, e.g. veryfast or slow (ffmpeg only).")
+    group.add_argument("--gop", type=int, default=None, help="GOP length / keyframe interval in frames (ffmpeg only).")
+    group.add_argument("--pix-fmt", type=str, default="yuv420p", help="Output pixel format (ffmpeg only).")
+    group.add_argument("--threads", type=int, default=0, help="Encoder thread count, 0 lets the encoder decide (ffmpeg only).")
+
+
+def encoder_settings_from_args(args):
+    return EncoderSettings(
+        backend=args.encoder, codec=args.codec, crf=args.crf, bitrate=args.bitrate,
+        preset=args.preset, gop=args.gop, pix_fmt=args.pix_fmt, threads=args.threads,
+    )
+
+# ===================================
+# QUALITY METRICS
+# ===================================
+def _box_mean(x, win):
+    """Mean over every win x win window of a (B, H, W) stack ('valid' region), using summed-area tables."""
+    c = np.cumsum(np.cumsum(x, axis=1, dtype=np.float64), axis=2)
+    c = np.pad(c, ((0, 0), (1, 0), (1, 0)))
+    s = c[:, win:, win:] - c[:, :-win, win:] - c[:, win:, :-win] + c[:, :-win, :-win]
+    return s / (win * win)
+
+
+def psnr_batch(ref, test, data_range=255.0):
+    """Per-frame PSNR of two (B, H, W) stacks. Identical frames give inf."""
+    diff = ref.astype(np.float32) - test.astype(np.float32)
+    mse = np.mean(diff * diff, axis=(1, 2))
+    with np.errstate(divide="ignore"):
+        return 10 * np.log10((data_range ** 2) / mse)
+
+
+def ssim_batch(ref, test, data_range=255.0, win=7):
+    """
+    Per-frame SSIM of two (B, H, W) stacks with a uniform win x win window and sample covariance,
+    matching the defaults of skimage.metrics.structural_similarity.
+    """
+    x = ref.astype(np.float64)
+    y = test.astype(np.float64)
+    c1 = (0.01 * data_range) ** 2
+    c2 = (0.03 * data_range) ** 2
+    cov_norm = win * win / (win * win - 1)
+
+    mu_x = _box_mean(x, win)
+    mu_y = _box_mean(y, win)
+    var_x = cov_norm * (_box_mean(x * x, win) - mu_x * mu_x)
+    var_y = cov_norm * (_box_mean(y * y, win) - mu_y * mu_y)
+    cov_xy = cov_norm * (_box_mean(x * y, win) - mu_x * mu_y)
+
+    ssim_map = ((2 * mu_x * mu_y + c1) * (2 * cov_xy + c2)) / ((mu_x ** 2 + mu_y ** 2 + c1) * (var_x + var_y + c2))
+    return ssim_map.mean(axis=(1, 2))
+
+
+METRICS_MODES = ("encoded", "resized")
+
+
+class QualityMetrics:
+    """
+    Accumulates PSNR/SSIM of a resolution rung against its source.
+
+    Every `sample_every`-th frame is kept: the rung frame is upscaled back to the source size and both
+    are compared on luma. Sampled frames are buffered and scored `batch_size` at a time with the
+    vectorized functions above. In "encoded" mode (the default) the sampled source luma is kept while
+    frames stream, and after encoding only the written rung is decoded again and scored against it, so
+    the scores include the codec's loss at the chosen CRF/bitrate. "resized" mode scores the resized
+    frames while they stream, before encoding, which isolates the resolution loss and needs no second decode.
+    """
+    def __init__(self, sample_every=5, batch_size=8, mode="encoded"):
+        if mode not in METRICS_MODES:
+            raise ValueError(f"Unknown metrics mode <{mode}>, expected one of {METRICS_MODES}")
+        self.sample_every = max(1, sample_every)
+        self.batch_size = max(1, batch_size)
+        self.mode = mode
+        self.frames = []
+        self.psnr = []
+        self.ssim = []
+        self._ref = []
+        self._test = []
+        self._sources = {}  # frame_idx -> source luma, kept for "encoded" mode
+
+    def add(self, frame_idx, source_frame, rung_frame):
+        """Score a rung frame against its source frame ("resized" mode, while frames stream)."""
+        if frame_idx % self.sample_every:
+            return
+        self._add_pair(frame_idx, cv2.cvtColor(source_frame, cv2.COLOR_BGR2GRAY), rung_frame)
+
+    def add_source(self, frame_idx, source_frame):
+        """Keep the luma of a sampled source frame while it streams, for score_encoded."""
+        if frame_idx % self.sample_every:
+            return
+        self._sources[frame_idx] = cv2.cvtColor(source_frame, cv2.COLOR_BGR2GRAY)
+
+    def score_encoded(self, output_file):
+        """Decode the written rung once and score its sampled frames against the kept source luma."""
+        cap = cv2.VideoCapture(output_file)
+        frame_idx = 0
+        # grab() advances without converting to BGR, only sampled frames are retrieved
+        while self._sources and cap.grab():
+            if frame_idx in self._sources:
+                ret, rung_frame = cap.retrieve()
+                if not ret:
+                    break
+                self._add_pair(frame_idx, self._sources.pop(frame_idx), rung_frame)
+            frame_idx += 1
+        cap.release()
+        self._sources = {}
+
+    def _add_pair(self, frame_idx, source_luma, rung_frame):
+        height, width = source_luma.shape[:2]
+        self.frames.append(frame_idx)
+        self._ref.append(source_luma)
+        upscaled = cv2.resize(rung_frame, (width, height), interpolation=cv2.INTER_LINEAR)
+        self._test.append(cv2.cvtColor(upscaled, cv2.COLOR_BGR2GRAY))
+        if len(self._ref) >= self.batch_size:
+            self._flush()
+
+    def _flush(self):
+        if not self._ref:
+            return
+        ref, test = np.stack(self._ref), np.stack(self._test)
+        self.psnr.extend(psnr_batch(ref, test).tolist())
+        self.ssim.extend(ssim_batch(ref, test).tolist())
+        self._ref, self._test = [], []
+
+    def summary(self):
+        self._flush()
+        # json has no inf: PSNR is averaged over frames that differ from the source, and is null when
+        # none do (e.g. the full-resolution rung scored before encoding)
+        finite_psnr = [p for p in self.psnr if np.isfinite(p)]
+        return {
+            "mode": self.mode,
+            "sampled_frames": len(self.frames),
+            "identical_frames": len(self.psnr) - len(finite_psnr),
+            "psnr_mean": float(np.mean(finite_psnr)) if finite_psnr else None,
+            "psnr_min": float(np.min(finite_psnr)) if finite_psnr else None,
+            "ssim_mean": float(np.mean(self.ssim)) if self.ssim else None,
+            "ssim_min": float(np.min(self.ssim)) if self.ssim else None,
+        }
+
+    def save(self, output_file, source_file):
+        """Write the per-file summary and per-frame scores as JSON next to the rung, return the summary."""
+        summary = self.summary()
+        record = {
+            "file": os.path.basename(output_file),
+            "source": os.path.basename(source_file),
+            "sample_every": self.sample_every,
+            **summary,
+            # frames identical to the source are stored with a null PSNR, like in the summary
+            "per_frame": [
+                {"frame": f, "psnr": p if np.isfinite(p) else None, "ssim": s}
+                for f, p, s in zip(self.frames, self.psnr, self.ssim)
+            ],
+        }
+        with open(metrics_path(output_file), "w") as f:
+            json.dump(record, f, indent=1)
+        return {"file": record["file"], "source": record["source"], **summary}
+
+
+def metrics_path(video_file):
+    return os.path.splitext(video_file)[0] + "_metrics.json"
+
+# ===================================
+# POSTER CACHE
+# ===================================
+POSTER_CACHE_FILE = "posters.npz"
+POSTER_JPEG_QUALITY = 90
+
+
+def _encode_image(image):
+    """JPEG bytes of a BGR image as a 1-D uint8 array, which npz stores without pickling."""
+    ok, buffer = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, POSTER_JPEG_QUALITY])
+    if not ok:
+        raise ValueError("Could not encode poster frame")
+    return buffer.reshape(-1)
+
+
+def _decode_image(array):
+    # caches written before posters were JPEG-encoded hold raw frames
+    return array if array.ndim == 3 else cv2.imdecode(array, cv2.IMREAD_COLOR)
+
+
+class PosterSampler:
+    """
+    Collects poster frames of a rung while it is streamed: the first frame at the rung's own resolution,
+    plus small thumbnails at evenly spaced positions for slider previews. Both are stored JPEG-encoded,
+    the thumbnails as one vertical strip, to keep the cache small next to the videos.
+    """
+    def __init__(self, num_thumbnails=10, thumbnail_width=160):
+        self.num_thumbnails = num_thumbnails
+        self.thumbnail_width = thumbnail_width
+        self.positions = []
+        self.poster = None
+        self.thumbnails = {}
+
+    def set_frame_count(self, frame_count):
+        last_frame = max(int(frame_count) - 1, 0)
+        self.positions = sorted(set(np.linspace(0, last_frame, self.num_thumbnails).round().astype(int).tolist()))
+
+    def add(self, frame_idx, frame):
+        if frame_idx == 0:
+            self.poster = frame.copy()
+        if frame_idx in self.positions:
+            height, width = frame.shape[:2]
+            # never upscale, a rung narrower than the thumbnail width is kept at its own size
+            thumb_width = min(self.thumbnail_width, width)
+            thumb_height = max(1, round(height * thumb_width / width))
+            self.thumbnails[frame_idx] = cv2.resize(frame, (thumb_width, thumb_height), interpolation=cv2.INTER_AREA)
+
+    def entries(self, filename):
+        """Arrays to store for this rung, keyed as <filename>/<field> in the cache file."""
+        if self.poster is None:
+            return {}
+        positions = sorted(self.thumbnails)
+        if positions:
+            thumbnails = _encode_image(np.concatenate([self.thumbnails[p] for p in positions]))
+        else:
+            # --poster-thumbnails 0 caches the poster only
+            thumbnails = np.empty(0, dtype=np.uint8)
+        return {
+            f"{filename}/poster": _encode_image(self.poster),
+            f"{filename}/positions": np.array(positions, dtype=np.int32),
+            f"{filename}/thumbnails": thumbnails,
+        }
+
+
+def sample_posters(file, num_thumbnails=10, thumbnail_width=160):
+    """Build a PosterSampler for an existing video by seeking to the sample positions."""
+    sampler = PosterSampler(num_thumbnails, thumbnail_width)
+    cap = cv2.VideoCapture(file)
+    if not cap.isOpened():
+        logger.warning(f"Cannot open {file}, no poster frames cached for it.")
+        return sampler
+    sampler.set_frame_count(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    for position in sorted(set([0] + sampler.positions)):
+        cap.set(cv2.CAP_PROP_POS_FRAMES, position)
+        ret, frame = cap.read()
+        if ret:
+            sampler.add(position, frame)
+    cap.release()
+    return sampler
+
+
+def save_poster_cache(dir, samplers):
+    """
+    Merge {filename: PosterSampler} into <dir>/posters.npz, keeping entries for other files. New entries
+    are appended to the existing file; it is only rewritten when entries are replaced, and then the
+    kept members are copied as stored bytes without being loaded as arrays.
+    """
+    cache_file = os.path.join(dir, POSTER_CACHE_FILE)
+    arrays = {}
+    for filename, sampler in samplers.items():
+        arrays.update(sampler.entries(filename))
+    members = {f"{key}.npy": array for key, array in arrays.items()}
+
+    existing = []
+    if os.path.exists(cache_file):
+        with zipfile.ZipFile(cache_file) as zf:
+            existing = zf.namelist()
+    replaced = set(existing) & set(members)
+    if replaced:
+        tmp_file = cache_file + ".tmp"
+        with zipfile.ZipFile(cache_file) as zin, zipfile.ZipFile(tmp_file, "w") as zout:
+            for name in existing:
+                if name not in replaced:
+                    zout.writestr(zin.getinfo(name), zin.read(name))
+            _write_npz_members(zout, members)
+        os.replace(tmp_file, cache_file)
+    else:
+        with zipfile.ZipFile(cache_file, "a" if existing else "w") as zf:
+            _write_npz_members(zf, members)
+    num_videos = len({name.rsplit("/", 1)[0] for name in existing} | {key.rsplit("/", 1)[0] for key in arrays})
+    logger.info(f"Poster cache with {num_videos} videos saved at {cache_file}")
+
+
+def _write_npz_members(zf, members):
+    """Write arrays into an open zip the way np.savez lays them out, so np.load reads them back."""
+    for name, array in members.items():
+        with zf.open(name, "w", force_zip64=True) as f:
+            np.lib.format.write_array(f, np.asanyarray(array), allow_pickle=False)
+
+
+def clip_key(label, filename):
+    """Identifies a rung across label directories, the same way archive members are named."""
+    return f"{label}/{filename}"
+
+
+class PosterCache:
+    """
+    Read side of the poster cache. Each directory's posters.npz, or the copies packed into a study
+    archive, is opened lazily, so only the entries that are actually shown get read. Entries are looked
+    up by clip_key(label, filename), since the same file name can exist under both labels.
+    """
+    def __init__(self, dirs=(), archive=None):
+        self.index = {}
+        self._thumbnails = (None, None, None)
+        for dir in dirs:
+            cache_file = os.path.join(dir, POSTER_CACHE_FILE)
+            if os.path.exists(cache_file):
+                self._add(os.path.basename(os.path.normpath(dir)), np.load(cache_file))
+        if archive is not None:
+            for label, npz in archive.open_posters():
+                self._add(label, npz)
+
+    def _add(self, label, npz):
+        for key in npz.files:
+            filename = key.rsplit("/", 1)[0]
+            self.index[clip_key(label, filename)] = (npz, filename)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def poster(self, key):
+        if key not in self.index:
+            return None
+        npz, filename = self.index[key]
+        return _decode_image(npz[f"{filename}/poster"])
+
+    def thumbnail(self, key, frame_idx):
+        """Return the cached thumbnail closest to frame_idx, or None if the file isn't cached."""
+        if key not in self.index:
+            return None
+        # keep the last file's thumbnails decoded, slider hovers ask for the same file many times in a row
+        if self._thumbnails[0] != key:
+            npz, filename = self.index[key]
+            positions, thumbnails = npz[f"{filename}/positions"], npz[f"{filename}/thumbnails"]
+            if len(positions) and thumbnails.ndim == 1:
+                thumbnails = np.split(cv2.imdecode(thumbnails, cv2.IMREAD_COLOR), len(positions))
+            self._thumbnails = (key, positions, thumbnails)
+        _, positions, thumbnails = self._thumbnails
+        if len(positions) == 0:
+            return None
+        return thumbnails[int(np.abs(positions - frame_idx).argmin())]
+
+    def close(self):
+        for npz in {id(npz): npz for npz, _ in self.index.values()}.values():
+            npz.close()
+        self.index = {}
+        self._thumbnails = (None, None, None)
+
 # ===================================
 # VIDEO PROCESSING UTILITY
 # ===================================
-def make_resolution_copy(file, resolution):
+def even_resolution(width, height):
+    """Round a target size down to even dimensions, which yuv420 encoders (and OpenCV's mp4v writer) require."""
+    return max(2, int(width) // 2 * 2), max(2, int(height) // 2 * 2)
+
+
+def make_resolution_copy(file, resolution, encoder_settings=None, quality_metrics=None, posters=None, profiler=None):
+    """
+    Write a resized copy of `file` next to it, suffixed with _{width}x{height}.
+    If a QualityMetrics instance is given it is fed while frames stream, and its results are saved next
+    to the output; the per-file summary is returned. A PosterSampler is filled with the rung's frames
+    in the same pass. A StageProfiler times decode, resize, write and the optional stages.
+    The resolution must be even, otherwise the encoder's output would not match the _WxH name.
+    """
+    if tuple(resolution) != even_resolution(*resolution):
+        raise ValueError(f"Resolution {resolution[0]}x{resolution[1]} is odd, round it with even_resolution first")
+    profiler = profiler or StageProfiler(enabled=False)
+    with profiler.span(file, f"{resolution[0]}x{resolution[1]}"):
+        return _make_resolution_copy(file, resolution, encoder_settings, quality_metrics, posters, profiler.stage)
+
+
+def _make_resolution_copy(file, resolution, encoder_settings, quality_metrics, posters, stage):
     file_dir, file_name = os.path.split(file)
     file_base, file_ext = os.path.splitext(file_name)
     
@@ -118,24 +1301,54 @@ def make_resolution_copy(file, resolution):
     width, height = resolution
     output_file = os.path.join(file_dir, f"{file_base}_{width}x{height}{file_ext}")
 
-    fourcc = cv2.VideoWriter_fourcc(*'mp4v')
     fps = cap.get(cv2.CAP_PROP_FPS)
-    out = cv2.VideoWriter(output_file, fourcc, fps, (width, height))
+    with stage("open", frames=0):
+        out = make_encoder(output_file, fps, (width, height), encoder_settings)
     
     cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+    if posters is not None:
+        posters.set_frame_count(cap.get(cv2.CAP_PROP_FRAME_COUNT))
 
+    frame_idx = 0
     while True:
-        ret, frame = cap.read()
+        with stage("decode") as record:
+            ret, frame = cap.read()
+            if not ret:
+                record.frames = 0
         if not ret:
             break
-        resized_frame = cv2.resize(frame, (width, height))
-        out.write(resized_frame)
+        with stage("resize"):
+            resized_frame = cv2.resize(frame, (width, height))
+        with stage("write"):
+            out.write(resized_frame)
+        if quality_metrics is not None:
+            with stage("metrics"):
+                if quality_metrics.mode == "resized":
+                    quality_metrics.add(frame_idx, frame, resized_frame)
+                else:
+                    quality_metrics.add_source(frame_idx, frame)
+        if posters is not None:
+            with stage("posters"):
+                posters.add(frame_idx, resized_frame)
+        frame_idx += 1
 
-    out.release()
+    # encoders that buffer or run in another process (ffmpeg) finish their work here
+    with stage("finalize", frames=0):
+        out.release()
     logger.info(f"\nCompressed video saved at {output_file}")
 
     cap.release()
 
+    if quality_metrics is not None:
+        with stage("metrics", frames=0):
+            if quality_metrics.mode == "encoded":
+                quality_metrics.score_encoded(output_file)
+            summary = quality_metrics.save(output_file, file)
+        if summary["sampled_frames"]:
+            psnr = "identical to source" if summary["psnr_mean"] is None else f"{summary['psnr_mean']:.2f} dB"
+            logger.info(f"PSNR {psnr}, SSIM {summary['ssim_mean']:.4f} ({summary['mode']}) for {output_file}")
+        return summary
+
 def is_original(file):
     """
     Check if a video doesn't have a resolution suffix, meaning it's an original video to be processed.
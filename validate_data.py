@@ -0,0 +1,47 @@
+import argparse
+import logging
+import sys
+import time
+import pandas as pd
+
+import utils
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger("Validate Data")
+
+
+def run_validation(video_dir, workers=None, sample_frames=5, report=None, archive=None):
+    """
+    Validate all rungs, or all clips of a study archive when one is given, log every problem and
+    optionally save the full report. Returns True if all passed.
+    """
+    start = time.perf_counter()
+    if archive:
+        results = utils.validate_archive(archive, workers, sample_frames)
+    else:
+        results = utils.validate_dataset(video_dir, workers, sample_frames)
+    elapsed = time.perf_counter() - start
+
+    df = pd.DataFrame(results)
+    if report:
+        df.to_csv(report, index=False)
+        logger.info(f"Validation report saved at {report}")
+
+    failed = df[~df["ok"]] if len(df) else df
+    for _, row in failed.iterrows():
+        logger.error(f"{row['path']}: {row['issues']}")
+    logger.info(f"Validated {len(df)} files in {elapsed:.1f}s, {len(failed)} with problems.")
+    return len(failed) == 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check every prepared resolution copy before running a session.")
+    parser.add_argument("--video_dir", type=str, default="ultrasounds", help="Directory in which ultrasound videos are located.")
+    parser.add_argument("--archive", type=str, default=None, help="Validate the clips of this study archive instead of --video_dir.")
+    parser.add_argument("--workers", type=int, default=None, help="Number of parallel workers, defaults to the executor's choice.")
+    parser.add_argument("--sample_frames", type=int, default=5, help="Number of frames decoded per file, spread evenly over the clip.")
+    parser.add_argument("--report", type=str, default="validation_report.csv", help="Where to save the full per-file report.")
+
+    args = parser.parse_args()
+    ok = run_validation(args.video_dir, args.workers, args.sample_frames, args.report, args.archive)
+    sys.exit(0 if ok else 1)